@@ -1,13 +1,26 @@
 import os
+import codecs
+import hashlib
+import time
+import atexit
 import sqlite3
 import logging
+import queue
+import threading
+import traceback
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
-import pandas as pd
 import telebot
-from telebot import types
-from html import escape
+from telebot import apihelper, types
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:  # необязательное ускорение, в requirements.txt не входит: без него разбираем JSON через requests
+    orjson = None
 
 # -------------------------
 # Настройка логирования
@@ -41,30 +54,55 @@ CSV_PATH = os.path.join(DATA_DIR, "demo.csv")
 # -------------------------
 # Инициализация бота
 # -------------------------
-bot = telebot.TeleBot(BOT_TOKEN)
+# Long-poll: infinity_polling вызываем с timeout=None, чтобы таймауты брались из apihelper.
+# Тогда для getUpdates read-таймаут = max(LONG_POLLING_TIMEOUT + 5, READ_TIMEOUT) = 40 с —
+# запас над окном long-poll; connect — CONNECT_TIMEOUT (15 с по умолчанию).
+# READ_TIMEOUT действует и на остальные вызовы API (sendMessage и т.п.)
+LONG_POLLING_TIMEOUT = 25
+apihelper.READ_TIMEOUT = 40
+
+class PollingTimeoutHandler(telebot.ExceptionHandler):
+    # Таймаут самого getUpdates на слабой сети ожидаем: пишем WARNING и продолжаем polling.
+    # Всё остальное, включая таймауты send_message/reply_to в хендлерах, идёт обычным путём
+    # и логируется telebot как ERROR
+    def handle(self, exception):
+        if (isinstance(exception, requests.exceptions.RequestException)
+                and "timed out" in str(exception)
+                and any(fr.name == "get_updates" for fr in traceback.extract_tb(exception.__traceback__))):
+            logger.warning(f"Таймаут long-poll getUpdates: {exception}")
+            return True
+        return False
+
+# По умолчанию у telebot всего 2 рабочих потока: пара медленных /ask (до 15 с)
+# блокировала всех остальных пользователей
+BOT_WORKERS = 8
+bot = telebot.TeleBot(BOT_TOKEN, num_threads=BOT_WORKERS, exception_handler=PollingTimeoutHandler())
 
 # -------------------------
-# Вспомогательные функции БД и миграции
+# HTML-экранирование для parse_mode="HTML"
 # -------------------------
-def connect():
-    return sqlite3.connect(DB_PATH)
+# один проход str.translate вместо пяти последовательных replace в html.escape
+_HTML_TRANS = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
 
-def table_exists(conn, name):
-    cur = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
-    return cur.fetchone() is not None
+def esc(s):
+    return s.translate(_HTML_TRANS) if s else ""
 
-def column_exists(conn, table, column):
-    cur = conn.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]
-    return column in cols
+# -------------------------
+# Вспомогательные функции БД и миграции
+# -------------------------
+def table_columns(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
 
 def ensure_tables_and_columns():
-    conn = connect()
-    cur = conn.cursor()
+    # isolation_level=None — транзакцией управляем сами: вся миграция в одном BEGIN ... COMMIT
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    conn.execute("BEGIN")
+    tables = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type='table'"))
+    columns = {}
 
     # users
-    if not table_exists(conn, "users"):
-        cur.execute("""
+    if "users" not in tables:
+        conn.execute("""
             CREATE TABLE users(
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -73,17 +111,16 @@ def ensure_tables_and_columns():
             )
         """)
         logger.info("Создана таблица users")
-    else:
-        if not column_exists(conn, "users", "fullname"):
-            cur.execute("ALTER TABLE users ADD COLUMN fullname TEXT")
-            logger.info("Добавлена колонка users.fullname")
-        if not column_exists(conn, "users", "reg_date"):
-            cur.execute("ALTER TABLE users ADD COLUMN reg_date TEXT")
-            logger.info("Добавлена колонка users.reg_date")
+    columns["users"] = cols = table_columns(conn, "users")
+    for col in ("fullname", "reg_date"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {col} TEXT")
+            cols.add(col)
+            logger.info(f"Добавлена колонка users.{col}")
 
     # queries
-    if not table_exists(conn, "queries"):
-        cur.execute("""
+    if "queries" not in tables:
+        conn.execute("""
             CREATE TABLE queries(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -94,15 +131,16 @@ def ensure_tables_and_columns():
             )
         """)
         logger.info("Создана таблица queries")
-    else:
-        for col in ("source", "params", "ts"):
-            if not column_exists(conn, "queries", col):
-                cur.execute(f"ALTER TABLE queries ADD COLUMN {col} TEXT")
-                logger.info(f"Добавлена колонка queries.{col}")
+    columns["queries"] = cols = table_columns(conn, "queries")
+    for col in ("source", "params", "ts"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE queries ADD COLUMN {col} TEXT")
+            cols.add(col)
+            logger.info(f"Добавлена колонка queries.{col}")
 
     # presets
-    if not table_exists(conn, "presets"):
-        cur.execute("""
+    if "presets" not in tables:
+        conn.execute("""
             CREATE TABLE presets(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -112,18 +150,71 @@ def ensure_tables_and_columns():
             )
         """)
         logger.info("Создана таблица presets")
-    else:
-        if not column_exists(conn, "presets", "content"):
-            cur.execute("ALTER TABLE presets ADD COLUMN content TEXT")
-            logger.info("Добавлена колонка presets.content")
-        if not column_exists(conn, "presets", "created_at"):
-            cur.execute("ALTER TABLE presets ADD COLUMN created_at TEXT")
-            logger.info("Добавлена колонка presets.created_at")
-
-    conn.commit()
+    columns["presets"] = cols = table_columns(conn, "presets")
+    for col in ("content", "created_at"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE presets ADD COLUMN {col} TEXT")
+            cols.add(col)
+            logger.info(f"Добавлена колонка presets.{col}")
+
+    # индексы под горячие запросы: история пользователя и поиск пресета по имени
+    # (users.user_id — PRIMARY KEY, отдельный индекс не нужен)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_queries_user_id ON queries(user_id, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_presets_user_name ON presets(user_id, name)")
+
+    conn.execute("COMMIT")
     conn.close()
-
-ensure_tables_and_columns()
+    return columns
+
+# Колонки таблиц после миграции: проверяем по ним, не повторяя PRAGMA table_info
+_SCHEMA = ensure_tables_and_columns()
+_USER_COLS = frozenset(_SCHEMA["users"])
+_QUERY_COLS = frozenset(_SCHEMA["queries"])
+_PRESET_COLS = frozenset(_SCHEMA["presets"])
+
+# Одно соединение на запись на весь процесс: хендлеры telebot работают в пуле
+# потоков, поэтому запись сериализуем через _WRITE_LOCK
+CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+CONN.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+""")
+_WRITE_LOCK = threading.Lock()
+
+# Пул соединений только на чтение: в WAL читатели не блокируют писателя и друг друга
+RO_POOL_SIZE = 4
+_RO_POOL = queue.Queue()
+for _ in range(RO_POOL_SIZE):
+    _ro = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    _ro.execute("PRAGMA temp_store=MEMORY")
+    _RO_POOL.put(_ro)
+
+@contextmanager
+def ro_conn():
+    conn = _RO_POOL.get()
+    try:
+        yield conn
+    finally:
+        _RO_POOL.put(conn)
+
+@contextmanager
+def rw_conn():
+    with _WRITE_LOCK:
+        yield CONN
+
+@contextmanager
+def rw_tx():
+    # несколько записей одной транзакцией — один fsync вместо N
+    with rw_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
 # -------------------------
 # Функции БД: пользователи, запросы, пресеты
@@ -131,66 +222,110 @@ ensure_tables_and_columns()
 def datetime_now():
     return datetime.utcnow().isoformat(sep=" ", timespec="seconds")
 
-def register_user(user):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users WHERE user_id=?", (user.id,))
-    if not cur.fetchone():
-        fullname = " ".join(filter(None, [user.first_name, user.last_name])) if user else ""
-        cur.execute("INSERT INTO users(user_id, username, fullname, reg_date) VALUES (?, ?, ?, ?)",
-                    (user.id, user.username, fullname, datetime_now()))
-        conn.commit()
+# Уже зарегистрированные user_id: для них handle_all не ходит в БД вовсе
+with ro_conn() as _conn:
+    _KNOWN_USERS = {r[0] for r in _conn.execute("SELECT user_id FROM users")}
+
+def register_user(user, ts=None):
+    fullname = " ".join(filter(None, [user.first_name, user.last_name])) if user else ""
+    # для уже известного пользователя конфликт по PRIMARY KEY — дешёвый no-op
+    with rw_conn() as conn:
+        cur = conn.execute("INSERT OR IGNORE INTO users(user_id, username, fullname, reg_date) VALUES (?, ?, ?, ?)",
+                           (user.id, user.username, fullname, ts or datetime_now()))
+    _KNOWN_USERS.add(user.id)
+    if cur.rowcount:
         logger.info(f"Зарегистрирован пользователь {user.username} ({user.id})")
-    conn.close()
-
-def log_query(user_id, text, source="user", params=None):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO queries(user_id, text, source, params, ts) VALUES(?,?,?,?,?)",
-                (user_id, text, source, str(params or {}), datetime_now()))
-    conn.commit()
-    qid = cur.lastrowid
-    conn.close()
-    return qid
 
 def list_history(user_id, limit=10):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("SELECT text, ts FROM queries WHERE user_id=? ORDER BY id DESC LIMIT ?", (user_id, limit))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def add_preset_db(user_id, name, content):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO presets(user_id, name, content, created_at) VALUES(?,?,?,?)",
-                (user_id, name, content, datetime_now()))
-    conn.commit()
-    conn.close()
+    with ro_conn() as conn:
+        cur = conn.execute("SELECT text, ts FROM queries WHERE user_id=? ORDER BY id DESC LIMIT ?", (user_id, limit))
+        return cur.fetchall()
+
+def add_preset_db(user_id, name, content, ts=None):
+    with rw_conn() as conn:
+        conn.execute("INSERT INTO presets(user_id, name, content, created_at) VALUES(?,?,?,?)",
+                     (user_id, name, content, ts or datetime_now()))
+
+def add_presets_bulk(user_id, items, ts=None):
+    # пачка пресетов (name, content) — одной транзакцией вместо коммита на каждый
+    ts = ts or datetime_now()
+    with rw_tx() as conn:
+        conn.executemany("INSERT INTO presets(user_id, name, content, created_at) VALUES(?,?,?,?)",
+                         [(user_id, name, content, ts) for name, content in items])
 
 def list_presets_db(user_id):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("SELECT name, content FROM presets WHERE user_id=?", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    with ro_conn() as conn:
+        cur = conn.execute("SELECT name, content FROM presets WHERE user_id=?", (user_id,))
+        return cur.fetchall()
 
 def get_preset_db(user_id, name):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("SELECT content FROM presets WHERE user_id=? AND name=?", (user_id, name))
-    row = cur.fetchone()
-    conn.close()
+    with ro_conn() as conn:
+        cur = conn.execute("SELECT content FROM presets WHERE user_id=? AND name=?", (user_id, name))
+        row = cur.fetchone()
     return row[0] if row else None
 
 def delete_preset_db(user_id, name):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM presets WHERE user_id=? AND name=?", (user_id, name))
-    conn.commit()
-    conn.close()
+    with rw_conn() as conn:
+        conn.execute("DELETE FROM presets WHERE user_id=? AND name=?", (user_id, name))
+
+# -------------------------
+# Журнал запросов: запись в фоне пачками, хендлеры не ждут диск
+# -------------------------
+LOG_FLUSH_INTERVAL = 0.5
+LOG_BATCH_SIZE = 16
+_LOG_Q = queue.Queue()
+_LOG_STOP = object()
+
+def log_query(user_id, text, source="user", params=None, ts=None):
+    _LOG_Q.put_nowait((user_id, text, source, str(params or {}), ts or datetime_now()))
+
+def _write_log_rows(rows):
+    try:
+        with rw_tx() as conn:
+            conn.executemany("INSERT INTO queries(user_id, text, source, params, ts) VALUES(?,?,?,?,?)", rows)
+    except Exception:
+        logger.exception("Ошибка записи журнала запросов")
+
+def _log_flusher():
+    stopping = False
+    while not stopping:
+        item = _LOG_Q.get()
+        if item is _LOG_STOP:
+            break
+        rows = [item]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = _LOG_Q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _LOG_STOP:
+                stopping = True
+                break
+            rows.append(item)
+        _write_log_rows(rows)
+
+def _stop_log_flusher():
+    # при остановке: сигнал в конец очереди и ждём, пока поток допишет
+    # свою текущую пачку и всё, что стоит перед сигналом
+    _LOG_Q.put(_LOG_STOP)
+    _LOG_FLUSHER.join()
+    # строки, попавшие в очередь уже после сигнала
+    rows = []
+    while True:
+        try:
+            rows.append(_LOG_Q.get_nowait())
+        except queue.Empty:
+            break
+    if rows:
+        _write_log_rows(rows)
+
+_LOG_FLUSHER = threading.Thread(target=_log_flusher, name="log-flusher", daemon=True)
+_LOG_FLUSHER.start()
+atexit.register(_stop_log_flusher)
 
 # -------------------------
 # CSV: создание демо, чтение с кодировками
@@ -209,55 +344,117 @@ def ensure_demo_csv():
             w.writerows(sample)
         logger.info("Создан demo.csv (пример)")
 
-def load_csv_safe():
-    ensure_demo_csv()
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+def detect_csv_encoding(path):
+    # BOM или проверка UTF-8 на первых 64 КБ — без повторного чтения всего файла
+    with open(path, "rb") as fh:
+        sample = fh.read(ENCODING_SAMPLE_SIZE)
+    for bom, enc in _BOMS:
+        if sample.startswith(bom):
+            return enc
     try:
-        df = pd.read_csv(CSV_PATH, encoding="utf-8")
-        logger.info(f"Загружен {CSV_PATH} (utf-8), строк: {len(df)}")
-        return df
+        # final=False: обрезанный на границе выборки многобайтовый символ не считается ошибкой
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
     except UnicodeDecodeError:
-        df = pd.read_csv(CSV_PATH, encoding="cp1251")
-        logger.info(f"Загружен {CSV_PATH} (cp1251), строк: {len(df)}")
-        return df
-    except Exception as e:
+        return "cp1251"
+
+def load_csv_safe(consume):
+    # Строки не копим в память: consume получает csv.DictReader и разбирает их по ходу чтения.
+    # Возвращает результат consume или None, если файл прочитать не удалось
+    # csv нужен только для /report — не тянем его в холодный старт бота
+    import csv
+    ensure_demo_csv()
+    try:
+        enc = detect_csv_encoding(CSV_PATH)
+        try:
+            with open(CSV_PATH, encoding=enc, newline="") as fh:
+                result = consume(csv.DictReader(fh))
+        except UnicodeDecodeError:
+            if enc != "utf-8":
+                raise
+            # не-UTF-8 байты встретились уже после проверенной выборки — читаем заново
+            enc = "cp1251"
+            with open(CSV_PATH, encoding=enc, newline="") as fh:
+                result = consume(csv.DictReader(fh))
+        logger.info(f"Загружен {CSV_PATH} ({enc})")
+        return result
+    except (OSError, UnicodeError, csv.Error) as e:
         logger.error(f"Ошибка при чтении CSV: {e}")
-        return pd.DataFrame()
+        return None
 
 # -------------------------
 # Анализ CSV — отчёт (без ошибок NaN)
 # -------------------------
+_REPORT_CACHE = {}
+
 def generate_report_from_demo():
-    df = load_csv_safe()
-    if df.empty:
-        return "⚠️ Данные отсутствуют или CSV некорректен."
+    # отчёт зависит только от содержимого CSV — пересчитываем, лишь когда файл изменился
+    ensure_demo_csv()
     try:
-        avg_salary = df["salary"].astype(float).mean() if "salary" in df.columns else None
-        top_cities = df["city"].value_counts().head(5) if "city" in df.columns else None
-        top_titles = df["title"].value_counts().head(5) if "title" in df.columns else None
-
-        skills_series = []
-        if "skills" in df.columns:
-            df_sk = df["skills"].dropna().astype(str)
-            skills = ";".join(df_sk.tolist()).split(";")
-            skills_series = pd.Series(skills).value_counts().head(10)
+        st = os.stat(CSV_PATH)
+        key = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+    cached = _REPORT_CACHE.get("demo")
+    if key is not None and cached and cached[0] == key:
+        return cached[1]
+    report = build_report_from_demo()
+    if key is not None:
+        _REPORT_CACHE["demo"] = (key, report)
+    return report
+
+def collect_demo_stats(reader):
+    # один проход по строкам вместо отдельного прохода pandas на каждую колонку
+    stats = {"rows": 0, "salary_sum": 0.0, "salary_n": 0,
+             "cities": Counter(), "titles": Counter(), "skills": Counter()}
+    for row in reader:
+        stats["rows"] += 1
+        salary = row.get("salary")
+        if salary:
+            stats["salary_sum"] += float(salary)
+            stats["salary_n"] += 1
+        if row.get("city"):
+            stats["cities"][row["city"]] += 1
+        if row.get("title"):
+            stats["titles"][row["title"]] += 1
+        if row.get("skills"):
+            # пустые элементы от "a;;b" или хвостового ";" в топ навыков не попадают
+            stats["skills"].update(s for s in map(str.strip, row["skills"].split(";")) if s)
+    return stats
+
+def build_report_from_demo():
+    try:
+        stats = load_csv_safe(collect_demo_stats)
+        if not stats or not stats["rows"]:
+            return "⚠️ Данные отсутствуют или CSV некорректен."
+        cities, titles, skills = stats["cities"], stats["titles"], stats["skills"]
 
         parts = []
         parts.append("<b>📊 Аналитический отчёт (demo.csv)</b>")
 
-        if avg_salary is not None and not pd.isna(avg_salary):
-            # безопасная конвертация
+        if stats["salary_n"]:
+            avg_salary = stats["salary_sum"] / stats["salary_n"]
             parts.append(f"💰 Средняя зарплата: <b>{int(round(avg_salary)):,} ₽</b>")
 
-        if top_cities is not None and not top_cities.empty:
-            cities_str = ", ".join([escape(str(c)) for c in top_cities.index])
+        if cities:
+            cities_str = ", ".join([esc(c) for c, _ in cities.most_common(5)])
             parts.append(f"🏙️ Топ городов: {cities_str}")
 
-        if top_titles is not None and not top_titles.empty:
-            titles_str = ", ".join([escape(str(t)) for t in top_titles.index])
+        if titles:
+            titles_str = ", ".join([esc(t) for t, _ in titles.most_common(5)])
             parts.append(f"💼 Топ вакансий: {titles_str}")
 
-        if isinstance(skills_series, pd.Series) and not skills_series.empty:
-            skills_str = ", ".join([escape(str(s)) for s in skills_series.index])
+        if skills:
+            skills_str = ", ".join([esc(s) for s, _ in skills.most_common(10)])
             parts.append(f"🔥 Частые навыки: {skills_str}")
 
         parts.append("\n⚠️ Это демонстрационный отчёт. Ответ составлен ботом-ассистентом.")
@@ -269,50 +466,102 @@ def generate_report_from_demo():
 # -------------------------
 # Клавиатура / меню
 # -------------------------
-def main_keyboard():
+def _build_main_keyboard():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.row("📊 Отчёт", "🧠 Пресеты")
     kb.row("📜 История", "👤 Профиль")
     kb.row("❓ Помощь")
     return kb
 
+# клавиатура не меняется — сериализуем её в JSON один раз, а не на каждое сообщение;
+# готовую строку telebot передаёт в reply_markup как есть
+MAIN_KB = _build_main_keyboard().to_json()
+
 # -------------------------
 # API-интеграции: OpenRouter и NewsAPI
 # -------------------------
+# Общая сессия с пулом keep-alive соединений: без нового TCP+TLS рукопожатия на каждый запрос
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+# ключ OpenRouter не кладём в SESSION.headers, иначе он уйдёт и в NewsAPI
+_OPENROUTER_HEADERS = {"Authorization": f"Bearer {OPENROUTER_API_KEY}"}
+
+def parse_json(r):
+    # orjson разбирает сырые байты ответа: быстрее json и без промежуточного r.text
+    return orjson.loads(r.content) if orjson else r.json()
+
+# Короткий TTL-кэш ответов: повторный /news по той же теме и двойная отправка /ask
+# не тратят запрос к API и квоту
+NEWS_CACHE_TTL = 300
+ASK_CACHE_TTL = 60
+API_CACHE_MAX = 256
+_NEWS_CACHE = {}
+_ASK_CACHE = {}
+_API_CACHE_LOCK = threading.Lock()
+
+def _cache_get(cache, key):
+    with _API_CACHE_LOCK:
+        hit = cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    return None
+
+def _cache_put(cache, key, value, ttl):
+    now = time.monotonic()
+    with _API_CACHE_LOCK:
+        # ключ переставляем в конец: порядок dict = порядок вставки = порядок истечения TTL
+        cache.pop(key, None)
+        if len(cache) >= API_CACHE_MAX:
+            for k in [k for k, (expiry, _) in cache.items() if expiry <= now]:
+                del cache[k]
+            # всё ещё живое — вытесняем самые старые записи
+            while len(cache) >= API_CACHE_MAX:
+                del cache[next(iter(cache))]
+        cache[key] = (now + ttl, value)
+
 def ask_neuron(question):
     if not OPENROUTER_API_KEY:
         raise RuntimeError("OPENROUTER_API_KEY not set")
+    key = hashlib.sha1(question.encode("utf-8")).hexdigest()
+    cached = _cache_get(_ASK_CACHE, key)
+    if cached is not None:
+        return cached
     # OpenRouter / OpenAI-like request (пример для OpenRouter)
     url = "https://api.openrouter.ai/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}"}
     payload = {
         "model": "gpt-4.1-mini",
         "messages": [{"role": "user", "content": question}],
         "max_tokens": 800
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=15)
+    r = SESSION.post(url, headers=_OPENROUTER_HEADERS, json=payload, timeout=15)
     r.raise_for_status()
-    j = r.json()
+    j = parse_json(r)
     # безопасный обход — ищем первый доступный текст
     try:
-        return j["choices"][0]["message"]["content"]
+        answer = j["choices"][0]["message"]["content"]
     except Exception:
-        return j.get("text") or str(j)
+        answer = j.get("text") or str(j)
+    _cache_put(_ASK_CACHE, key, answer, ASK_CACHE_TTL)
+    return answer
 
 def get_news(topic, limit=5):
     if not NEWS_API_KEY:
         raise RuntimeError("NEWS_API_KEY not set")
+    cached = _cache_get(_NEWS_CACHE, (topic, limit))
+    if cached is not None:
+        return cached
     url = f"https://newsapi.org/v2/everything"
     params = {"q": topic, "pageSize": limit, "language": "ru", "apiKey": NEWS_API_KEY}
-    r = requests.get(url, params=params, timeout=10)
+    r = SESSION.get(url, params=params, timeout=10)
     r.raise_for_status()
-    j = r.json()
+    j = parse_json(r)
     articles = j.get("articles", [])
     result_lines = []
     for a in articles:
-        title = escape(a.get("title") or "Без заголовка")
+        title = esc(a.get("title") or "Без заголовка")
         urla = a.get("url") or ""
-        result_lines.append(f"{title}\n{escape(urla)}")
+        result_lines.append(f"{title}\n{esc(urla)}")
+    _cache_put(_NEWS_CACHE, (topic, limit), result_lines, NEWS_CACHE_TTL)
     return result_lines
 
 # -------------------------
@@ -323,13 +572,13 @@ def handle_start(message):
     register_user(message.from_user)
     # убрали небезопасный вид <вопрос> — используем пояснения без <...>
     msg = (
-        f"👋 Привет, <b>{escape(message.from_user.first_name or message.from_user.username)}</b>!\n\n"
+        f"👋 Привет, <b>{esc(message.from_user.first_name or message.from_user.username)}</b>!\n\n"
         "Я — Помощник_Аналитика. Выбери действие:\n\n"
         "• Используй команду /ask  чтобы задать вопрос нейросети\n"
         "• Используй команду /news чтобы получить новости по теме\n\n"
         "Или выбери пункт в меню ниже."
     )
-    bot.send_message(message.chat.id, msg, parse_mode="HTML", reply_markup=main_keyboard())
+    bot.send_message(message.chat.id, msg, parse_mode="HTML", reply_markup=MAIN_KB)
 
 @bot.message_handler(commands=["help"])
 def handle_help(message):
@@ -347,13 +596,13 @@ def handle_help(message):
         "/news <тема> — получить новости по теме (пиши после команды)\n"
     )
     # help_text содержит символы < и > в описании команд — отправим без HTML-парсинга
-    bot.send_message(message.chat.id, help_text, reply_markup=main_keyboard())
+    bot.send_message(message.chat.id, help_text, reply_markup=MAIN_KB)
 
 @bot.message_handler(commands=["report"])
 def handle_report_cmd(message):
-    qid = log_query(message.from_user.id, "/report", source="command")
+    log_query(message.from_user.id, "/report", source="command")
     report = generate_report_from_demo()
-    bot.send_message(message.chat.id, report, parse_mode="HTML", reply_markup=main_keyboard())
+    bot.send_message(message.chat.id, report, parse_mode="HTML", reply_markup=MAIN_KB)
 
 @bot.message_handler(commands=["preset_add"])
 def handle_preset_add(message):
@@ -363,9 +612,10 @@ def handle_preset_add(message):
             bot.reply_to(message, "Использование: /preset_add имя текст")
             return
         _, name, content = parts
-        add_preset_db(message.from_user.id, name, content)
-        log_query(message.from_user.id, f"/preset_add {name}", source="command")
-        bot.reply_to(message, f"✅ Пресет '{escape(name)}' сохранён.")
+        ts = datetime_now()
+        add_preset_db(message.from_user.id, name, content, ts)
+        log_query(message.from_user.id, f"/preset_add {name}", source="command", ts=ts)
+        bot.reply_to(message, f"✅ Пресет '{esc(name)}' сохранён.")
     except Exception as e:
         logger.exception("preset_add error")
         bot.reply_to(message, "⚠️ Ошибка при сохранении пресета.")
@@ -376,7 +626,7 @@ def handle_preset_list(message):
     if not rows:
         bot.reply_to(message, "У тебя нет пресетов.")
         return
-    text = "📚 Твои пресеты:\n" + "\n".join([f"• {escape(r[0])} — {escape(r[1][:60])}..." for r in rows])
+    text = "📚 Твои пресеты:\n" + "\n".join([f"• {esc(r[0])} — {esc(r[1][:60])}..." for r in rows])
     bot.reply_to(message, text)
 
 @bot.message_handler(commands=["preset_use"])
@@ -388,10 +638,10 @@ def handle_preset_use(message):
         return
     content = get_preset_db(message.from_user.id, name)
     if not content:
-        bot.reply_to(message, f"Пресет '{escape(name)}' не найден.")
+        bot.reply_to(message, f"Пресет '{esc(name)}' не найден.")
     else:
         log_query(message.from_user.id, f"/preset_use {name}", source="command")
-        bot.reply_to(message, f"📋 Пресет '{escape(name)}':\n\n{escape(content)}")
+        bot.reply_to(message, f"📋 Пресет '{esc(name)}':\n\n{esc(content)}")
 
 @bot.message_handler(commands=["preset_del"])
 def handle_preset_del(message):
@@ -402,29 +652,27 @@ def handle_preset_del(message):
         return
     delete_preset_db(message.from_user.id, name)
     log_query(message.from_user.id, f"/preset_del {name}", source="command")
-    bot.reply_to(message, f"🗑 Пресет '{escape(name)}' удалён.")
+    bot.reply_to(message, f"🗑 Пресет '{esc(name)}' удалён.")
 
 @bot.message_handler(commands=["profile"])
 def handle_profile(message):
-    conn = connect()
-    cur = conn.cursor()
-    cur.execute("SELECT username, fullname, reg_date FROM users WHERE user_id=?", (message.from_user.id,))
-    row = cur.fetchone()
-    conn.close()
+    with ro_conn() as conn:
+        cur = conn.execute("SELECT username, fullname, reg_date FROM users WHERE user_id=?", (message.from_user.id,))
+        row = cur.fetchone()
     if not row:
         bot.reply_to(message, "Профиль не найден. Нажми /start.")
         return
     username, fullname, reg_date = row
-    bot.reply_to(message, f"👤 Профиль:\nИмя: {escape(fullname)}\nUsername: @{escape(username or '')}\nРегистрация: {escape(reg_date or '')}")
+    bot.reply_to(message, f"👤 Профиль:\nИмя: {esc(fullname)}\nUsername: @{esc(username or '')}\nРегистрация: {esc(reg_date or '')}")
 
 @bot.message_handler(commands=["history"])
 def handle_history(message):
     rows = list_history(message.from_user.id, limit=10)
     if not rows:
-        bot.reply_to(message, "История пуста.", reply_markup=main_keyboard())
+        bot.reply_to(message, "История пуста.", reply_markup=MAIN_KB)
         return
-    lines = [f"• {escape(r[0])}  —  {escape(r[1])}" for r in rows]
-    bot.reply_to(message, "📜 Последние запросы:\n\n" + "\n".join(lines), reply_markup=main_keyboard())
+    lines = [f"• {esc(r[0])}  —  {esc(r[1])}" for r in rows]
+    bot.reply_to(message, "📜 Последние запросы:\n\n" + "\n".join(lines), reply_markup=MAIN_KB)
 
 @bot.message_handler(commands=["ask"])
 def handle_ask(message):
@@ -438,10 +686,10 @@ def handle_ask(message):
         answer = ask_neuron(text)
     except Exception as e:
         logger.exception("ask_neuron error")
-        bot.reply_to(message, f"⚠️ Ошибка при обращении к нейросети: {escape(str(e))}")
+        bot.reply_to(message, f"⚠️ Ошибка при обращении к нейросети: {esc(str(e))}")
         return
     # ответ может содержать любые символы — экранируем перед отправкой с HTML
-    bot.send_message(message.chat.id, escape(answer), parse_mode="HTML", reply_markup=main_keyboard())
+    bot.send_message(message.chat.id, esc(answer), parse_mode="HTML", reply_markup=MAIN_KB)
 
 @bot.message_handler(commands=["news"])
 def handle_news(message):
@@ -455,41 +703,48 @@ def handle_news(message):
         articles = get_news(topic, limit=5)
     except Exception as e:
         logger.exception("get_news error")
-        bot.reply_to(message, f"⚠️ Ошибка при получении новостей: {escape(str(e))}")
+        bot.reply_to(message, f"⚠️ Ошибка при получении новостей: {esc(str(e))}")
         return
     if not articles:
-        bot.reply_to(message, "📰 Новостей не найдено или сервис недоступен.", reply_markup=main_keyboard())
+        bot.reply_to(message, "📰 Новостей не найдено или сервис недоступен.", reply_markup=MAIN_KB)
         return
     text = "\n\n".join(articles)
     # articles уже экранированы в get_news
-    bot.send_message(message.chat.id, text, parse_mode="HTML", reply_markup=main_keyboard())
+    bot.send_message(message.chat.id, text, parse_mode="HTML", reply_markup=MAIN_KB)
 
 # -------------------------
 # Обработка обычных сообщений (меню)
 # -------------------------
+PRESETS_MENU_TEXT = "Управление пресетами:\n/preset_add имя текст\n/preset_list\n/preset_use имя\n/preset_del имя"
+
+def handle_presets_menu(message):
+    bot.send_message(message.chat.id, PRESETS_MENU_TEXT, reply_markup=MAIN_KB)
+
+def handle_unknown(message):
+    bot.send_message(message.chat.id, "Не распознано. Используй меню или /help.", reply_markup=MAIN_KB)
+
+# кнопка меню -> хендлер: один поиск в словаре вместо цепочки сравнений строк
+_MENU = {
+    "📊 Отчёт": handle_report_cmd,
+    "🧠 Пресеты": handle_presets_menu,
+    "📜 История": handle_history,
+    "👤 Профиль": handle_profile,
+    "❓ Помощь": handle_help,
+}
+
 @bot.message_handler(func=lambda m: True)
 def handle_all(message):
     text = (message.text or "").strip()
-    register_user(message.from_user)
+    # одна метка времени на сообщение — и для регистрации, и для журнала
+    ts = datetime_now()
+    if message.from_user.id not in _KNOWN_USERS:
+        register_user(message.from_user, ts)
     try:
-        log_query(message.from_user.id, text, source="message")
+        log_query(message.from_user.id, text, source="message", ts=ts)
     except Exception:
         logger.exception("Ошибка логирования")
 
-    if text == "📊 Отчёт":
-        handle_report_cmd(message)
-    elif text == "🧠 Пресеты":
-        bot.send_message(message.chat.id,
-                         "Управление пресетами:\n/preset_add имя текст\n/preset_list\n/preset_use имя\n/preset_del имя",
-                         reply_markup=main_keyboard())
-    elif text == "📜 История":
-        handle_history(message)
-    elif text == "👤 Профиль":
-        handle_profile(message)
-    elif text == "❓ Помощь":
-        handle_help(message)
-    else:
-        bot.send_message(message.chat.id, "Не распознано. Используй меню или /help.", reply_markup=main_keyboard())
+    _MENU.get(text, handle_unknown)(message)
 
 # -------------------------
 # Запуск
@@ -498,5 +753,5 @@ if __name__ == "__main__":
     ensure_demo_csv()
     logger.info("✅ База данных и demo.csv готовы.")
     logger.info("🚀 Бот Помощник_Аналитика запущен")
-    bot.infinity_polling()
+    bot.infinity_polling(timeout=None, long_polling_timeout=LONG_POLLING_TIMEOUT, skip_pending=True)
 